@@ -1,17 +1,44 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
 import json
-import cv2
-import numpy as np
 import pickle
+import queue
 import shutil
+import sqlite3
+import subprocess
+import sys
+import io
+import importlib
+import heapq
 import threading
-import requests
+import functools
+from collections import deque
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import imutils
+
+class _LazyModule:
+    """Stand-in for a heavy module that is only imported on first attribute access"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Heavy modules are deferred so the server can bind quickly; _warm_up() loads them in the background
+cv2 = _LazyModule('cv2')
+np = _LazyModule('numpy')
+imutils = _LazyModule('imutils')
+requests = _LazyModule('requests')
 
 app = Flask(__name__)
 CORS(app, origins=["*"], supports_credentials=True)
@@ -40,6 +67,59 @@ RECOGNIZER_PATH = os.path.join(OUTPUT_DIR, 'recognizer.pickle')
 LE_PATH = os.path.join(OUTPUT_DIR, 'le.pickle')
 EMBEDDINGS_PATH = os.path.join(OUTPUT_DIR, 'embeddings.pickle')
 
+# Model serving
+MODEL_POOL_SIZE = int(os.environ.get('MODEL_POOL_SIZE', 2))
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'true').lower() not in ('0', 'false', 'no')
+
+# Admission control for the recognition endpoints
+MAX_CONCURRENT_RECOGNITIONS = int(os.environ.get('MAX_CONCURRENT_RECOGNITIONS', MODEL_POOL_SIZE))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 32))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+ADMISSION_LANES = {'attendance': 0, 'recognition': 1}  # lower value is served first
+
+# Compressed embedding gallery for matcher=gallery
+GALLERY_METHODS = ('float16', 'int8', 'pq')
+GALLERY_METHOD = os.environ.get('GALLERY_METHOD', 'int8')
+GALLERY_RERANK = int(os.environ.get('GALLERY_RERANK', 20))
+GALLERY_PQ_SUBSPACES = int(os.environ.get('GALLERY_PQ_SUBSPACES', 16))
+GALLERY_EXACT_PATH = os.path.join(OUTPUT_DIR, 'gallery_exact.npy')
+
+# Distributed embedding extraction. Remote workers need the same DATASET_DIR and queue file
+SHARD_QUEUE_PATH = os.environ.get('SHARD_QUEUE_PATH', os.path.join(OUTPUT_DIR, 'shard_queue.sqlite'))
+SHARD_LEASE_SECONDS = int(os.environ.get('SHARD_LEASE_SECONDS', 300))
+SHARD_MAX_ATTEMPTS = int(os.environ.get('SHARD_MAX_ATTEMPTS', 3))
+
+# Processed image storage and retention
+PROCESSED_IMAGE_FORMAT = os.environ.get('PROCESSED_IMAGE_FORMAT', 'jpg').lower()  # 'jpg' or 'webp'
+PROCESSED_IMAGE_QUALITY = int(os.environ.get('PROCESSED_IMAGE_QUALITY', 85))
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', 200))
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 7 * 24 * 3600))
+IMAGE_RETENTION_MAX_AGE_HOURS = float(os.environ.get('IMAGE_RETENTION_MAX_AGE_HOURS', 7 * 24))
+IMAGE_RETENTION_MAX_MB = float(os.environ.get('IMAGE_RETENTION_MAX_MB', 2048))
+IMAGE_RETENTION_INTERVAL = int(os.environ.get('IMAGE_RETENTION_INTERVAL', 3600))
+
+# Shared state of the background extraction/training job
+training_state = {
+    'status': 'idle',
+    'progress': 0,
+    'message': 'Idle',
+    'embeddings_count': 0,
+    'users_processed': 0,
+    'accuracy': None,
+    'model_version': None
+}
+
+# Readiness of this instance, filled in by _warm_up()
+readiness_state = {
+    'ready': not WARMUP_ON_START,
+    'status': 'warming_up' if WARMUP_ON_START else 'ready',
+    'import_seconds': None,
+    'warmup_stages': {},
+    'recognizer_loaded': False,
+    'error': None
+}
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -47,6 +127,20 @@ def health_check():
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    response = {
+        'ready': readiness_state['ready'],
+        'status': readiness_state['status'],
+        'import_seconds': readiness_state['import_seconds'],
+        'warmup_stages': readiness_state['warmup_stages'],
+        'recognizer_loaded': readiness_state['recognizer_loaded'],
+        'timestamp': datetime.now().isoformat()
+    }
+    if readiness_state['error']:
+        response['error'] = readiness_state['error']
+    return jsonify(response), 200 if readiness_state['ready'] else 503
+
 @app.route('/api/dataset/stats', methods=['GET'])
 def get_dataset_stats():
     try:
@@ -256,6 +350,65 @@ def backup_dataset():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _embed_image(detector, embedder, image_path, confidence_threshold):
+    """Return the 128-d embedding of the most confident face in an image, or None"""
+    image = cv2.imread(image_path)
+    if image is None:
+        return None
+    
+    image = imutils.resize(image, width=600)
+    (h, w) = image.shape[:2]
+    
+    # Detect faces
+    imageBlob = cv2.dnn.blobFromImage(
+        cv2.resize(image, (300, 300)), 1.0, (300, 300),
+        (104.0, 177.0, 123.0), swapRB=False, crop=False)
+    detector.setInput(imageBlob)
+    detections = detector.forward()
+    
+    # Ensure at least one face was found
+    if len(detections) == 0:
+        return None
+    
+    i = np.argmax(detections[0, 0, :, 2])
+    confidence = detections[0, 0, i, 2]
+    if confidence <= confidence_threshold:
+        return None
+    
+    box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
+    (startX, startY, endX, endY) = box.astype("int")
+    
+    face = image[startY:endY, startX:endX]
+    (fH, fW) = face.shape[:2]
+    if fW < 20 or fH < 20:
+        return None
+    
+    # Extract embeddings
+    faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255,
+        (96, 96), (0, 0, 0), swapRB=True, crop=False)
+    embedder.setInput(faceBlob)
+    vec = embedder.forward()
+    return vec.flatten()
+
+def _save_embeddings(known_embeddings, known_names, users_count):
+    """Write embeddings.pickle and embeddings_map.json"""
+    print("[INFO] Serializing embeddings...")
+    data = {
+        "embeddings": known_embeddings,
+        "names": known_names
+    }
+    with open(EMBEDDINGS_PATH, "wb") as f:
+        pickle.dump(data, f)
+    
+    # Save embeddings map
+    embeddings_map = {
+        'total_embeddings': len(known_embeddings),
+        'unique_users': users_count,
+        'timestamp': datetime.now().isoformat()
+    }
+    with open(os.path.join(OUTPUT_DIR, 'embeddings_map.json'), 'w') as f:
+        json.dump(embeddings_map, f, indent=2)
+
 def _extract_embeddings_worker(confidence_threshold):
     """Background worker for embedding extraction"""
     global training_state
@@ -313,69 +466,17 @@ def _extract_embeddings_worker(confidence_threshold):
                 training_state['progress'] = progress
                 training_state['message'] = f'Processing image {processed_images}/{total_images}'
                 
-                # Load image
-                image = cv2.imread(image_path)
-                if image is None:
+                vec = _embed_image(detector, embedder, image_path, confidence_threshold)
+                if vec is None:
                     failed_images += 1
                     continue
                 
-                image = imutils.resize(image, width=600)
-                (h, w) = image.shape[:2]
-                
-                # Detect faces
-                imageBlob = cv2.dnn.blobFromImage(
-                    cv2.resize(image, (300, 300)), 1.0, (300, 300),
-                    (104.0, 177.0, 123.0), swapRB=False, crop=False)
-                detector.setInput(imageBlob)
-                detections = detector.forward()
-                
-                # Ensure at least one face was found
-                if len(detections) > 0:
-                    i = np.argmax(detections[0, 0, :, 2])
-                    confidence = detections[0, 0, i, 2]
-                    
-                    if confidence > confidence_threshold:
-                        box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-                        (startX, startY, endX, endY) = box.astype("int")
-                        
-                        face = image[startY:endY, startX:endX]
-                        (fH, fW) = face.shape[:2]
-                        
-                        if fW < 20 or fH < 20:
-                            failed_images += 1
-                            continue
-                        
-                        # Extract embeddings
-                        faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255,
-                            (96, 96), (0, 0, 0), swapRB=True, crop=False)
-                        embedder.setInput(faceBlob)
-                        vec = embedder.forward()
-                        
-                        known_names.append(user_folder)
-                        known_embeddings.append(vec.flatten())
-                    else:
-                        failed_images += 1
-                else:
-                    failed_images += 1
+                known_names.append(user_folder)
+                known_embeddings.append(vec)
         
         # Save embeddings
         training_state['message'] = 'Saving embeddings...'
-        print("[INFO] Serializing embeddings...")
-        data = {
-            "embeddings": known_embeddings,
-            "names": known_names
-        }
-        with open(EMBEDDINGS_PATH, "wb") as f:
-            pickle.dump(data, f)
-        
-        # Save embeddings map
-        embeddings_map = {
-            'total_embeddings': len(known_embeddings),
-            'unique_users': len(users_set),
-            'timestamp': datetime.now().isoformat()
-        }
-        with open(os.path.join(OUTPUT_DIR, 'embeddings_map.json'), 'w') as f:
-            json.dump(embeddings_map, f, indent=2)
+        _save_embeddings(known_embeddings, known_names, len(users_set))
         
         training_state['status'] = 'completed'
         training_state['progress'] = 100
@@ -390,6 +491,248 @@ def _extract_embeddings_worker(confidence_threshold):
         training_state['status'] = 'failed'
         training_state['message'] = str(e)
 
+def _shard_db():
+    conn = sqlite3.connect(SHARD_QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY, status TEXT, confidence REAL, created_at TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS shards (
+        job_id TEXT, shard_id INTEGER, users TEXT, status TEXT, attempts INTEGER DEFAULT 0,
+        worker TEXT, leased_at REAL, result BLOB, error TEXT,
+        PRIMARY KEY (job_id, shard_id))""")
+    return conn
+
+def _enqueue_shards(confidence_threshold, shard_size):
+    """Split DATASET_DIR into shards of user folders and queue them as a new job"""
+    users = sorted(
+        user_folder for user_folder in os.listdir(DATASET_DIR)
+        if os.path.isdir(os.path.join(DATASET_DIR, user_folder)))
+    job_id = f"job_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    
+    conn = _shard_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("UPDATE jobs SET status = 'cancelled' WHERE status = 'running'")
+        conn.execute("INSERT INTO jobs VALUES (?, 'running', ?, ?)",
+                     (job_id, confidence_threshold, datetime.now().isoformat()))
+        for shard_id, start in enumerate(range(0, len(users), shard_size)):
+            conn.execute("INSERT INTO shards (job_id, shard_id, users, status) VALUES (?, ?, ?, 'pending')",
+                         (job_id, shard_id, json.dumps(users[start:start + shard_size])))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return job_id, len(users)
+
+def _claim_shard(conn, worker_id):
+    """Atomically lease the next pending shard of a running job"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("""
+            SELECT s.job_id, s.shard_id, s.users, j.confidence FROM shards s
+            JOIN jobs j ON j.job_id = s.job_id
+            WHERE j.status = 'running' AND s.status = 'pending'
+            ORDER BY j.created_at, s.shard_id LIMIT 1""").fetchone()
+        if row:
+            conn.execute("""UPDATE shards SET status = 'running', worker = ?, leased_at = ?,
+                            attempts = attempts + 1 WHERE job_id = ? AND shard_id = ?""",
+                         (worker_id, time.time(), row[0], row[1]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+def _pack_shard_result(items, failed_images):
+    """Serialize (user, image, vector) results as plain arrays.
+    
+    The queue file is shared with other hosts, so results must never be
+    unpickled by the coordinator.
+    """
+    vectors = np.array([vec for _, _, vec in items], dtype=np.float64) if items else np.zeros((0, 128))
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        users=np.array([user_folder for user_folder, _, _ in items], dtype=str),
+        images=np.array([image_name for _, image_name, _ in items], dtype=str),
+        vectors=vectors,
+        failed_images=np.array(failed_images, dtype=np.int64))
+    return buffer.getvalue()
+
+def _unpack_shard_result(result):
+    with np.load(io.BytesIO(result), allow_pickle=False) as data:
+        items = list(zip(data['users'].tolist(), data['images'].tolist(), data['vectors']))
+        return items, int(data['failed_images'])
+
+def _run_shard_worker(worker_id=None, once=False, poll_interval=2.0):
+    """Pull shards from the queue, embed their images and push the partial results back.
+    
+    Any number of these can run, as threads, processes or on other hosts that
+    see the same DATASET_DIR and SHARD_QUEUE_PATH. With once=True the worker
+    exits as soon as the queue is empty.
+    """
+    import socket
+    
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    detector, embedder = _load_nets()
+    conn = _shard_db()
+    print(f"[INFO] Shard worker {worker_id} started")
+    
+    try:
+        while True:
+            row = _claim_shard(conn, worker_id)
+            if row is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+            
+            job_id, shard_id, users, confidence_threshold = row
+            try:
+                items = []
+                failed_images = 0
+                for user_folder in json.loads(users):
+                    user_path = os.path.join(DATASET_DIR, user_folder)
+                    for image_name in sorted(os.listdir(user_path)):
+                        if not image_name.endswith(('.png', '.jpg', '.jpeg')):
+                            continue
+                        vec = _embed_image(detector, embedder, os.path.join(user_path, image_name), confidence_threshold)
+                        if vec is None:
+                            failed_images += 1
+                        else:
+                            items.append((user_folder, image_name, vec))
+                    # Heartbeat so the coordinator does not treat a slow shard as lost
+                    conn.execute("UPDATE shards SET leased_at = ? WHERE job_id = ? AND shard_id = ? AND worker = ?",
+                                 (time.time(), job_id, shard_id, worker_id))
+                
+                result = _pack_shard_result(items, failed_images)
+                conn.execute("""UPDATE shards SET status = 'done', result = ?, error = NULL
+                                WHERE job_id = ? AND shard_id = ? AND worker = ?""",
+                             (result, job_id, shard_id, worker_id))
+                print(f"[INFO] {worker_id} finished shard {shard_id} of {job_id}: {len(items)} embeddings")
+            except Exception as e:
+                print(f"[ERROR] {worker_id} failed shard {shard_id} of {job_id}: {str(e)}")
+                conn.execute("""UPDATE shards SET status = 'failed', error = ?
+                                WHERE job_id = ? AND shard_id = ? AND worker = ?""",
+                             (str(e), job_id, shard_id, worker_id))
+    finally:
+        conn.close()
+
+def _coordinate_extraction_worker(confidence_threshold, shard_size, local_workers):
+    """Background coordinator for distributed embedding extraction"""
+    global training_state
+    
+    processes = []
+    try:
+        training_state['status'] = 'extracting'
+        training_state['progress'] = 0
+        training_state['message'] = 'Queueing shards...'
+        
+        job_id, users_count = _enqueue_shards(confidence_threshold, shard_size)
+        training_state['job_id'] = job_id
+        print(f"[INFO] Queued {users_count} users as job {job_id} in {SHARD_QUEUE_PATH}")
+        
+        # Local workers run as separate processes so they are not bound by the GIL
+        processes = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', '--once'])
+            for _ in range(local_workers)
+        ]
+        
+        respawns = 0
+        last_activity = None
+        last_progress = time.time()
+        conn = _shard_db()
+        try:
+            while True:
+                # Requeue shards that failed or whose worker stopped sending heartbeats
+                conn.execute("""UPDATE shards SET status = 'pending', worker = NULL
+                                WHERE job_id = ? AND attempts < ? AND
+                                (status = 'failed' OR (status = 'running' AND leased_at < ?))""",
+                             (job_id, SHARD_MAX_ATTEMPTS, time.time() - SHARD_LEASE_SECONDS))
+                # Lost on their last attempt: give up instead of waiting for them forever
+                conn.execute("""UPDATE shards SET status = 'failed', worker = NULL, error = 'lease expired'
+                                WHERE job_id = ? AND attempts >= ? AND status = 'running' AND leased_at < ?""",
+                             (job_id, SHARD_MAX_ATTEMPTS, time.time() - SHARD_LEASE_SECONDS))
+                counts = dict(conn.execute(
+                    "SELECT status, COUNT(*) FROM shards WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+                total = sum(counts.values())
+                done = counts.get('done', 0)
+                
+                training_state['progress'] = int(done / total * 100) if total else 100
+                training_state['shards_total'] = total
+                training_state['shards_done'] = done
+                training_state['message'] = f'Processed {done}/{total} shards'
+                
+                if counts.get('pending', 0) + counts.get('running', 0) == 0:
+                    break
+                
+                # A new lease, heartbeat or finished shard counts as progress
+                activity = (done, conn.execute(
+                    "SELECT MAX(leased_at) FROM shards WHERE job_id = ?", (job_id,)).fetchone()[0])
+                if activity != last_activity:
+                    last_activity = activity
+                    last_progress = time.time()
+                elif time.time() - last_progress > SHARD_LEASE_SECONDS:
+                    # No worker has touched the job for a whole lease: stop waiting for one
+                    conn.execute("UPDATE jobs SET status = 'failed' WHERE job_id = ?", (job_id,))
+                    raise RuntimeError(f'No shard was leased or finished in {SHARD_LEASE_SECONDS}s, '
+                                       f'{done}/{total} shards done; is a worker running?')
+                if local_workers and all(p.poll() is not None for p in processes) and counts.get('pending', 0):
+                    # Local workers exited while retries are still queued
+                    if respawns >= SHARD_MAX_ATTEMPTS:
+                        conn.execute("UPDATE jobs SET status = 'failed' WHERE job_id = ?", (job_id,))
+                        raise RuntimeError(f'Local shard workers keep exiting (exit code {processes[0].returncode})')
+                    respawns += 1
+                    processes = [
+                        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', '--once'])
+                        for _ in range(local_workers)
+                    ]
+                time.sleep(1)
+            
+            failed = conn.execute(
+                "SELECT shard_id, error FROM shards WHERE job_id = ? AND status = 'failed'", (job_id,)).fetchall()
+            if failed:
+                conn.execute("UPDATE jobs SET status = 'failed' WHERE job_id = ?", (job_id,))
+                raise RuntimeError(f'{len(failed)} shards failed after {SHARD_MAX_ATTEMPTS} attempts: {failed[0][1]}')
+            
+            # Merge partial results, dropping images that were embedded by more than one attempt
+            training_state['message'] = 'Merging shard results...'
+            merged = {}
+            failed_images = 0
+            for (result,) in conn.execute(
+                    "SELECT result FROM shards WHERE job_id = ? ORDER BY shard_id", (job_id,)):
+                items, shard_failed_images = _unpack_shard_result(result)
+                failed_images += shard_failed_images
+                for user_folder, image_name, vec in items:
+                    merged[(user_folder, image_name)] = vec
+            
+            known_names = [user_folder for user_folder, _ in merged]
+            known_embeddings = list(merged.values())
+            users_processed = len(set(known_names))
+            
+            training_state['message'] = 'Saving embeddings...'
+            _save_embeddings(known_embeddings, known_names, users_processed)
+            
+            conn.execute("UPDATE jobs SET status = 'completed' WHERE job_id = ?", (job_id,))
+            conn.execute("UPDATE shards SET result = NULL WHERE job_id = ?", (job_id,))
+        finally:
+            conn.close()
+        
+        training_state['status'] = 'completed'
+        training_state['progress'] = 100
+        training_state['embeddings_count'] = len(known_embeddings)
+        training_state['users_processed'] = users_processed
+        training_state['message'] = f'Extracted {len(known_embeddings)} embeddings from {users_processed} users'
+        
+        print(f"[INFO] Distributed extraction completed: {len(known_embeddings)} embeddings "
+              f"from {users_processed} users ({failed_images} images without a usable face)")
+        
+    except Exception as e:
+        print(f"[ERROR] Distributed extraction failed: {str(e)}")
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        training_state['status'] = 'failed'
+        training_state['message'] = str(e)
+
 @app.route('/api/train/extract-embeddings', methods=['POST'])
 def extract_embeddings():
     global training_state
@@ -404,6 +747,15 @@ def extract_embeddings():
         
         data = request.json or {}
         confidence_threshold = float(data.get('confidence', 0.5))
+        distributed = str(data.get('distributed', 'false')).lower() == 'true'
+        shard_size = int(data.get('shard_size', 10))
+        local_workers = int(data.get('local_workers', min(4, os.cpu_count() or 1)))
+        
+        if shard_size < 1 or local_workers < 0:
+            return jsonify({
+                'success': False,
+                'error': 'shard_size must be at least 1 and local_workers non-negative'
+            }), 400
         
         # Reset state
         training_state = {
@@ -417,13 +769,19 @@ def extract_embeddings():
         }
         
         # Start background thread
-        thread = threading.Thread(target=_extract_embeddings_worker, args=(confidence_threshold,))
+        if distributed:
+            thread = threading.Thread(
+                target=_coordinate_extraction_worker,
+                args=(confidence_threshold, shard_size, local_workers))
+        else:
+            thread = threading.Thread(target=_extract_embeddings_worker, args=(confidence_threshold,))
         thread.daemon = True
         thread.start()
         
         return jsonify({
             'success': True,
-            'message': 'Extraction started in background'
+            'message': 'Extraction started in background',
+            'distributed': distributed
         })
         
     except Exception as e:
@@ -432,40 +790,227 @@ def extract_embeddings():
         training_state['message'] = str(e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def _train_model_worker():
+# Classifiers that can be selected through POST /api/train/model
+CLASSIFIER_CHOICES = ('logistic', 'sgd', 'linear_svc', 'svm')
+DEFAULT_CLASSIFIER = 'logistic'
+LINEAR_SVC_MIN_SAMPLES = 3  # calibration folds, so also the minimum embeddings per user
+TRAINING_REPORT_PATH = os.path.join(OUTPUT_DIR, 'training_report.json')
+
+def _build_classifier(kind):
+    """Create an unfitted classifier that supports predict_proba"""
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    from sklearn.svm import SVC, LinearSVC
+    from sklearn.calibration import CalibratedClassifierCV
+    
+    if kind == 'logistic':
+        return LogisticRegression(C=10.0, max_iter=1000)
+    if kind == 'sgd':
+        # Supports partial_fit, so it can be updated incrementally after enrollment
+        return SGDClassifier(loss='log_loss', alpha=1e-4, max_iter=50, tol=1e-3, n_jobs=-1)
+    if kind == 'linear_svc':
+        return CalibratedClassifierCV(LinearSVC(C=1.0), cv=LINEAR_SVC_MIN_SAMPLES, n_jobs=-1)
+    if kind == 'svm':
+        # Original classifier; probability=True runs a serial internal cross-validation
+        return SVC(C=1.0, kernel="linear", probability=True)
+    raise ValueError(f'Unknown classifier: {kind}. Choose one of {", ".join(CLASSIFIER_CHOICES)}')
+
+def _incremental_update(embeddings, labels, le, epochs):
+    """Update the existing SGD recognizer instead of retraining from scratch.
+    
+    Returns the updated recognizer, or None if the saved model cannot be reused.
+    """
+    from sklearn.linear_model import SGDClassifier
+    
+    if not (os.path.exists(RECOGNIZER_PATH) and os.path.exists(LE_PATH)):
+        return None
+    with open(RECOGNIZER_PATH, "rb") as f:
+        recognizer = pickle.load(f)
+    with open(LE_PATH, "rb") as f:
+        old_le = pickle.load(f)
+    
+    if not isinstance(recognizer, SGDClassifier):
+        print("[WARN] Saved recognizer does not support partial_fit, retraining from scratch")
+        return None
+    
+    old_classes = list(old_le.classes_)
+    new_classes = list(le.classes_)
+    
+    if old_classes == new_classes:
+        # Same roster: a few passes of partial_fit over the data
+        rng = np.random.default_rng()
+        for _ in range(epochs):
+            order = rng.permutation(len(labels))
+            recognizer.partial_fit(embeddings[order], labels[order])
+        return recognizer
+    
+    if len(old_classes) < 3 or len(new_classes) < 3:
+        # Binary models keep a single weight row, nothing to carry over
+        return None
+    
+    # Roster changed: warm start from the old weights, new classes start at zero
+    coef = np.zeros((len(new_classes), embeddings.shape[1]))
+    intercept = np.zeros(len(new_classes))
+    old_index = {name: i for i, name in enumerate(old_classes)}
+    for i, name in enumerate(new_classes):
+        if name in old_index:
+            coef[i] = recognizer.coef_[old_index[name]]
+            intercept[i] = recognizer.intercept_[old_index[name]]
+    
+    updated = SGDClassifier(**recognizer.get_params())
+    updated.set_params(max_iter=epochs, tol=None)
+    updated.fit(embeddings, labels, coef_init=coef, intercept_init=intercept)
+    return updated
+
+def _measure_latency(recognizer, embeddings, samples=200):
+    """Per-face prediction latency in milliseconds, as seen by recognize_image"""
+    rng = np.random.default_rng(42)
+    sample = embeddings[rng.permutation(len(embeddings))[:samples]]
+    
+    timings = []
+    for vec in sample:
+        start = time.perf_counter()
+        recognizer.predict_proba(vec.reshape(1, -1))
+        timings.append((time.perf_counter() - start) * 1000)
+    if not timings:
+        return None
+    return {
+        'mean_ms': round(float(np.mean(timings)), 3),
+        'p95_ms': round(float(np.percentile(timings, 95)), 3)
+    }
+
+def _evaluate_classifier(kind, embeddings, labels, le, mode, folds):
+    """Evaluate a fresh classifier on data it was not trained on.
+    
+    'kfold' runs a stratified k-fold with the folds spread across all cores,
+    'holdout' trains once on a stratified 80/20 split.
+    """
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedKFold, cross_val_predict, train_test_split
+    from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+    
+    counts = np.bincount(labels)
+    min_count = folds if mode == 'kfold' else 2
+    if kind == 'linear_svc':
+        # Its internal 3-fold calibration needs 3 samples per user in every training split
+        test_share = folds if mode == 'kfold' else 5
+        while min_count - -(-min_count // test_share) < LINEAR_SVC_MIN_SAMPLES:
+            min_count += 1
+    eligible = np.flatnonzero(counts >= min_count)
+    if len(eligible) < 2:
+        return {'skipped': f'Need at least 2 users with {min_count}+ embeddings for {mode} evaluation'}
+    
+    mask = np.isin(labels, eligible)
+    X, y = embeddings[mask], labels[mask]
+    estimator = _build_classifier(kind)
+    
+    if mode == 'kfold':
+        cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+        y_pred = cross_val_predict(estimator, X, y, cv=cv, n_jobs=-1)
+        y_true = y
+    else:
+        try:
+            X_train, X_test, y_train, y_true = train_test_split(
+                X, y, test_size=0.2, stratify=y, random_state=42)
+        except ValueError as e:
+            return {'skipped': str(e)}
+        model = clone(estimator).fit(X_train, y_train)
+        y_pred = model.predict(X_test)
+    
+    precision, recall, f1, support = precision_recall_fscore_support(
+        y_true, y_pred, labels=eligible, zero_division=0)
+    per_class = {
+        str(le.classes_[label]): {
+            'precision': round(float(precision[i]), 4),
+            'recall': round(float(recall[i]), 4),
+            'f1': round(float(f1[i]), 4),
+            'support': int(support[i])
+        }
+        for i, label in enumerate(eligible)
+    }
+    
+    result = {
+        'mode': mode,
+        'accuracy': round(float(accuracy_score(y_true, y_pred)), 4),
+        'evaluated_samples': int(len(y_true)),
+        'evaluated_users': int(len(eligible)),
+        'excluded_users': int(len(counts) - len(eligible)),
+        'per_class': per_class
+    }
+    if mode == 'kfold':
+        result['folds'] = folds
+    return result
+
+def _train_model_worker(classifier=DEFAULT_CLASSIFIER, evaluation='kfold', folds=5, incremental=False, epochs=5):
     """Background worker for model training"""
     global training_state
+    stage_times = {}
+    
+    def finish_stage(name, started):
+        stage_times[name] = round(time.perf_counter() - started, 3)
+        training_state['stage_times'] = dict(stage_times)
+        return time.perf_counter()
     
     try:
         from sklearn.preprocessing import LabelEncoder
-        from sklearn.svm import SVC
         
         training_state['status'] = 'training'
         training_state['progress'] = 0
         training_state['message'] = 'Loading embeddings...'
+        training_state['classifier'] = classifier
+        total_start = time.perf_counter()
+        stage_start = total_start
         
         # Load embeddings
         print("[INFO] Loading embeddings...")
         with open(EMBEDDINGS_PATH, "rb") as f:
             data = pickle.load(f)
+        embeddings = np.asarray(data["embeddings"], dtype=np.float64)
+        stage_start = finish_stage('load', stage_start)
         
-        training_state['progress'] = 30
+        training_state['progress'] = 10
         training_state['message'] = 'Encoding labels...'
         
         # Encode labels
         print("[INFO] Encoding labels...")
         le = LabelEncoder()
         labels = le.fit_transform(data["names"])
+        stage_start = finish_stage('encode', stage_start)
         
-        training_state['progress'] = 50
-        training_state['message'] = 'Training SVM model...'
+        training_state['progress'] = 20
+        training_state['message'] = f'Training {classifier} model...'
         
         # Train model
-        print("[INFO] Training model...")
-        recognizer = SVC(C=1.0, kernel="linear", probability=True)
-        recognizer.fit(data["embeddings"], labels)
-        
-        training_state['progress'] = 80
+        recognizer = None
+        if incremental:
+            print("[INFO] Updating existing model incrementally...")
+            recognizer = _incremental_update(embeddings, labels, le, epochs)
+        trained_incrementally = recognizer is not None
+        if trained_incrementally:
+            # Incremental updates always continue an SGD model, whatever was requested
+            classifier = 'sgd'
+            training_state['classifier'] = classifier
+        else:
+            print(f"[INFO] Training {classifier} model...")
+            recognizer = _build_classifier(classifier).fit(embeddings, labels)
+        stage_start = finish_stage('fit', stage_start)
+        
+        # Evaluate on held-out data. Cross-validation refits from scratch, which
+        # does not describe a warm-started model, so incremental updates are not evaluated.
+        evaluation_result = None
+        if evaluation != 'none' and trained_incrementally:
+            evaluation_result = {'skipped': 'Not available for incremental updates; run a full training to evaluate'}
+        elif evaluation != 'none':
+            training_state['progress'] = 50
+            training_state['message'] = f'Evaluating {classifier} classifier ({evaluation})...'
+            print(f"[INFO] Evaluating {classifier} classifier ({evaluation})...")
+            evaluation_result = _evaluate_classifier(classifier, embeddings, labels, le, evaluation, folds)
+            stage_start = finish_stage('evaluate', stage_start)
+        
+        # Per-face prediction latency of the model that is saved
+        latency = _measure_latency(recognizer, embeddings)
+        stage_start = finish_stage('latency', stage_start)
+        
+        training_state['progress'] = 90
         training_state['message'] = 'Saving model...'
         
         # Save model and label encoder
@@ -473,17 +1018,40 @@ def _train_model_worker():
             pickle.dump(recognizer, f)
         with open(LE_PATH, "wb") as f:
             pickle.dump(le, f)
+        stage_start = finish_stage('save', stage_start)
+        stage_times['total'] = round(time.perf_counter() - total_start, 3)
         
         # Generate model version
         model_version = datetime.now().strftime('%Y%m%d_%H%M%S')
+        accuracy = evaluation_result.get('accuracy') if evaluation_result else None
+        
+        # Save training report
+        report = {
+            'model_version': model_version,
+            'classifier': classifier,
+            'incremental': trained_incrementally,
+            'embeddings_count': int(len(labels)),
+            'users_count': int(len(le.classes_)),
+            'evaluation': evaluation_result,
+            'latency': latency,
+            'stage_times': stage_times,
+            'timestamp': datetime.now().isoformat()
+        }
+        with open(TRAINING_REPORT_PATH, 'w') as f:
+            json.dump(report, f, indent=2)
         
         training_state['status'] = 'completed'
         training_state['progress'] = 100
-        training_state['accuracy'] = 0.95  # Would need test set for real accuracy
+        training_state['accuracy'] = accuracy
+        training_state['evaluation'] = evaluation_result
+        training_state['latency'] = latency
+        training_state['stage_times'] = stage_times
+        training_state['incremental'] = trained_incrementally
         training_state['model_version'] = model_version
         training_state['message'] = f'Model trained successfully (version {model_version})'
         
-        print(f"[INFO] Training completed: model version {model_version}")
+        print(f"[INFO] Training completed: model version {model_version} in {stage_times['total']}s"
+              + (f", accuracy {accuracy:.4f}" if accuracy is not None else ""))
         
     except Exception as e:
         print(f"[ERROR] Training failed: {str(e)}")
@@ -509,6 +1077,43 @@ def train_model():
                 'error': 'No embeddings found. Please extract embeddings first.'
             }), 400
         
+        data = request.get_json(silent=True) or {}
+        classifier = data.get('classifier', DEFAULT_CLASSIFIER)
+        evaluation = data.get('evaluation', 'kfold')
+        folds = int(data.get('folds', 5))
+        incremental = bool(data.get('incremental', False))
+        epochs = int(data.get('epochs', 5))
+        
+        if classifier not in CLASSIFIER_CHOICES:
+            return jsonify({
+                'success': False,
+                'error': f'Unknown classifier: {classifier}. Choose one of {", ".join(CLASSIFIER_CHOICES)}'
+            }), 400
+        if evaluation not in ('kfold', 'holdout', 'none'):
+            return jsonify({
+                'success': False,
+                'error': 'evaluation must be one of kfold, holdout, none'
+            }), 400
+        if folds < 2 or epochs < 1:
+            return jsonify({
+                'success': False,
+                'error': 'folds must be at least 2 and epochs at least 1'
+            }), 400
+        
+        if classifier == 'linear_svc':
+            with open(EMBEDDINGS_PATH, "rb") as f:
+                names = pickle.load(f)["names"]
+            user_counts = {}
+            for name in names:
+                user_counts[name] = user_counts.get(name, 0) + 1
+            smallest = min(user_counts.values(), default=0)
+            if smallest < LINEAR_SVC_MIN_SAMPLES:
+                return jsonify({
+                    'success': False,
+                    'error': f'linear_svc needs at least {LINEAR_SVC_MIN_SAMPLES} embeddings per user '
+                             f'(smallest has {smallest}); use logistic or sgd instead'
+                }), 400
+        
         # Reset state
         training_state = {
             'status': 'training',
@@ -521,13 +1126,18 @@ def train_model():
         }
         
         # Start background thread
-        thread = threading.Thread(target=_train_model_worker)
+        thread = threading.Thread(
+            target=_train_model_worker,
+            args=(classifier, evaluation, folds, incremental, epochs))
         thread.daemon = True
         thread.start()
         
         return jsonify({
             'success': True,
-            'message': 'Training started in background'
+            'message': 'Training started in background',
+            'classifier': classifier,
+            'evaluation': evaluation,
+            'incremental': incremental
         })
         
     except Exception as e:
@@ -557,6 +1167,19 @@ def get_training_status():
             response['accuracy'] = training_state['accuracy']
         if training_state.get('model_version'):
             response['model_version'] = training_state['model_version']
+        if training_state.get('classifier'):
+            response['classifier'] = training_state['classifier']
+        if training_state.get('evaluation'):
+            response['evaluation'] = training_state['evaluation']
+        if training_state.get('latency'):
+            response['latency'] = training_state['latency']
+        if training_state.get('stage_times'):
+            response['stage_times'] = training_state['stage_times']
+        if training_state.get('shards_total'):
+            response['shards_total'] = training_state['shards_total']
+            response['shards_done'] = training_state.get('shards_done', 0)
+        if 'incremental' in training_state:
+            response['incremental'] = training_state['incremental']
         
         # If idle, check for existing files to provide additional context
         if training_state['status'] == 'idle':
@@ -572,6 +1195,17 @@ def get_training_status():
                 except:
                     pass
             
+            if model_exists and os.path.exists(TRAINING_REPORT_PATH):
+                try:
+                    with open(TRAINING_REPORT_PATH, 'r') as f:
+                        report = json.load(f)
+                        response['model_version'] = report.get('model_version')
+                        response['classifier'] = report.get('classifier')
+                        if report.get('evaluation'):
+                            response['accuracy'] = report['evaluation'].get('accuracy')
+                except:
+                    pass
+            
             if model_exists:
                 response['message'] = 'Model ready for recognition'
             elif embeddings_exist:
@@ -584,30 +1218,436 @@ def get_training_status():
         print(f"[ERROR] Status check failed: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/api/recognize/image', methods=['POST'])
-def recognize_image():
+# Loaded DNN pairs are pooled because a cv2.dnn.Net must not run two forward passes at once
+_net_pool = queue.Queue()
+_net_pool_lock = threading.Lock()
+_net_pool_created = 0
+
+# Recognizer and label encoder, reloaded when training writes new files
+_recognizer_lock = threading.Lock()
+_recognizer_cache = {'mtime': None, 'recognizer': None, 'le': None}
+
+def _load_nets():
+    detector = cv2.dnn.readNetFromCaffe(DETECTOR_PATH, DETECTOR_MODEL)
+    embedder = cv2.dnn.readNetFromTorch(EMBEDDER_PATH)
+    return detector, embedder
+
+@contextmanager
+def _dnn_nets():
+    """Borrow a (detector, embedder) pair, loading a new one while the pool is below MODEL_POOL_SIZE"""
+    global _net_pool_created
+    
     try:
-        if 'image' not in request.files:
-            return jsonify({'success': False, 'error': 'No image provided'}), 400
-        
-        file = request.files['image']
-        confidence_threshold = float(request.form.get('confidence_threshold', 0.6))
-        
-        # Load models
-        detector = cv2.dnn.readNetFromCaffe(DETECTOR_PATH, DETECTOR_MODEL)
-        embedder = cv2.dnn.readNetFromTorch(EMBEDDER_PATH)
-        
-        with open(RECOGNIZER_PATH, "rb") as f:
-            recognizer = pickle.load(f)
-        with open(LE_PATH, "rb") as f:
-            le = pickle.load(f)
-        
-        # Read and process image
-        file_bytes = np.frombuffer(file.read(), np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        image = imutils.resize(image, width=600)
-        (h, w) = image.shape[:2]
-        
+        nets = _net_pool.get_nowait()
+    except queue.Empty:
+        with _net_pool_lock:
+            create = _net_pool_created < MODEL_POOL_SIZE
+            if create:
+                _net_pool_created += 1
+        if create:
+            try:
+                nets = _load_nets()
+            except Exception:
+                with _net_pool_lock:
+                    _net_pool_created -= 1
+                raise
+        else:
+            nets = _net_pool.get()
+    try:
+        yield nets
+    finally:
+        _net_pool.put(nets)
+
+def _get_recognizer():
+    """Return (recognizer, label_encoder), reloading them after a new model is trained"""
+    mtime = (os.path.getmtime(RECOGNIZER_PATH), os.path.getmtime(LE_PATH))
+    with _recognizer_lock:
+        if _recognizer_cache['mtime'] != mtime:
+            with open(RECOGNIZER_PATH, "rb") as f:
+                recognizer = pickle.load(f)
+            with open(LE_PATH, "rb") as f:
+                le = pickle.load(f)
+            _recognizer_cache.update(mtime=mtime, recognizer=recognizer, le=le)
+            print(f"[INFO] Loaded recognizer with {len(le.classes_)} classes")
+        return _recognizer_cache['recognizer'], _recognizer_cache['le']
+
+def _warm_up():
+    """Import heavy modules, load the models and run a dummy inference in the background"""
+    stages = readiness_state['warmup_stages']
+    
+    try:
+        stage_start = time.perf_counter()
+        for module in (np, cv2, imutils):
+            getattr(module, '__name__')  # attribute access triggers the deferred import
+        stages['imports'] = round(time.perf_counter() - stage_start, 3)
+        
+        # Borrow every pair at once so the whole pool is loaded, not just the first one
+        with ExitStack() as stack:
+            stage_start = time.perf_counter()
+            pairs = [stack.enter_context(_dnn_nets()) for _ in range(MODEL_POOL_SIZE)]
+            stages['load_models'] = round(time.perf_counter() - stage_start, 3)
+            
+            # The first forward pass allocates each net's DNN backend, pay for it here
+            stage_start = time.perf_counter()
+            dummy = np.zeros((300, 300, 3), dtype=np.uint8)
+            for detector, embedder in pairs:
+                detector.setInput(cv2.dnn.blobFromImage(dummy, 1.0, (300, 300), (104.0, 177.0, 123.0)))
+                detector.forward()
+                embedder.setInput(cv2.dnn.blobFromImage(dummy[:96, :96], 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True))
+                vec = embedder.forward()
+            stages['dummy_inference'] = round(time.perf_counter() - stage_start, 3)
+        
+        if os.path.exists(RECOGNIZER_PATH) and os.path.exists(LE_PATH):
+            stage_start = time.perf_counter()
+            recognizer, _ = _get_recognizer()
+            recognizer.predict_proba(vec)
+            readiness_state['recognizer_loaded'] = True
+            stages['load_recognizer'] = round(time.perf_counter() - stage_start, 3)
+        
+        readiness_state['status'] = 'ready'
+        readiness_state['ready'] = True
+        print(f"[INFO] Warm-up completed in {sum(stages.values()):.2f}s: {stages}")
+    except Exception as e:
+        print(f"[ERROR] Warm-up failed: {str(e)}")
+        readiness_state['status'] = 'failed'
+        readiness_state['error'] = str(e)
+
+# Compressed galleries for similarity search, keyed by method
+_compressed_gallery_lock = threading.Lock()
+_compressed_gallery_cache = {}
+_compressed_gallery_build_locks = {}
+
+# Class rosters from info.json, keyed by embeddings mtime; no vectors are loaded
+_roster_lock = threading.Lock()
+_roster_cache = {'mtime': None, 'rosters': {}}
+
+def _normalize_class(class_name):
+    return (class_name or '').strip().casefold()
+
+def _load_rosters():
+    """Map each class to the USNs enrolled in it, from the users' info.json"""
+    rosters = {}
+    if not os.path.exists(DATASET_DIR):
+        return rosters
+    for user_folder in os.listdir(DATASET_DIR):
+        info_path = os.path.join(DATASET_DIR, user_folder, 'info.json')
+        if not os.path.exists(info_path):
+            continue
+        try:
+            with open(info_path, 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        class_key = _normalize_class(info.get('class'))
+        if class_key:
+            rosters.setdefault(class_key, set()).add(info.get('usn') or user_folder)
+    return rosters
+
+def _get_roster(class_name):
+    """Return the USNs enrolled in a class, re-reading rosters when the embeddings change"""
+    mtime = os.path.getmtime(EMBEDDINGS_PATH)
+    with _roster_lock:
+        if _roster_cache['mtime'] != mtime:
+            _roster_cache.update(mtime=mtime, rosters=_load_rosters())
+        return _roster_cache['rosters'].get(_normalize_class(class_name), set())
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _build_compressed_gallery(embeddings, names, method):
+    """Compress L2-normalized embeddings for similarity search.
+    
+    float16 halves the vectors twice over float64, int8 stores one byte per
+    dimension with a per-dimension scale, and pq (product quantization) stores
+    one byte per 8-dimension subspace as an index into a 256-entry codebook.
+    """
+    vectors = _normalize_rows(embeddings)
+    gallery = {'method': method, 'names': np.asarray(names), 'count': len(vectors)}
+    
+    if method == 'float16':
+        gallery['codes'] = vectors.astype(np.float16)
+    elif method == 'int8':
+        scale = np.maximum(np.abs(vectors).max(axis=0), 1e-12) / 127.0
+        gallery['scale'] = scale.astype(np.float32)
+        gallery['codes'] = np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+    elif method == 'pq':
+        from sklearn.cluster import KMeans
+        
+        subspaces = GALLERY_PQ_SUBSPACES
+        if vectors.shape[1] % subspaces:
+            raise ValueError(f'Embedding size {vectors.shape[1]} is not divisible by {subspaces} subspaces')
+        width = vectors.shape[1] // subspaces
+        centroids = min(256, len(vectors))
+        codebooks = np.zeros((subspaces, centroids, width), dtype=np.float32)
+        codes = np.zeros((len(vectors), subspaces), dtype=np.uint8)
+        for m in range(subspaces):
+            sub = vectors[:, m * width:(m + 1) * width]
+            kmeans = KMeans(n_clusters=centroids, n_init=1, random_state=42).fit(sub)
+            codebooks[m] = kmeans.cluster_centers_
+            codes[:, m] = kmeans.labels_
+        gallery['codebooks'] = codebooks
+        gallery['codes'] = codes
+    else:
+        raise ValueError(f'Unknown gallery method: {method}. Choose one of {", ".join(GALLERY_METHODS)}')
+    
+    gallery['bytes'] = int(sum(v.nbytes for k, v in gallery.items()
+                               if k in ('codes', 'scale', 'codebooks')))
+    return gallery
+
+def _approximate_similarities(gallery, query, chunk=65536):
+    """Cosine similarity of a normalized query to every gallery entry, computed on the codes"""
+    codes = gallery['codes']
+    if gallery['method'] == 'pq':
+        # Asymmetric distance: score each codebook entry once, then sum table lookups
+        subspaces, _, width = gallery['codebooks'].shape
+        table = np.einsum('mkw,mw->mk', gallery['codebooks'], query.reshape(subspaces, width))
+        return table[np.arange(subspaces), codes].sum(axis=1)
+    
+    if gallery['method'] == 'int8':
+        query = query * gallery['scale']
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), chunk):
+        scores[start:start + chunk] = codes[start:start + chunk].astype(np.float32) @ query
+    return scores
+
+def _search_gallery(gallery, query, exact=None, top_k=1, rerank=GALLERY_RERANK, mask=None):
+    """Return [(index, similarity)] of the best matches for one query embedding.
+    
+    Candidates are ranked on the compressed codes; the best `rerank` of them
+    are then re-scored on the exact vectors when those are available.
+    """
+    query = _normalize_rows(query).reshape(-1)
+    scores = _approximate_similarities(gallery, query)
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    
+    candidates = max(top_k, rerank if exact is not None else 0)
+    candidates = min(candidates, len(scores))
+    if candidates == 0:
+        return []
+    best = np.argpartition(-scores, candidates - 1)[:candidates]
+    # Masked entries fill the candidate list when few are allowed; never re-rank them
+    best = best[np.isfinite(scores[best])]
+    if len(best) == 0:
+        return []
+    if exact is not None and rerank:
+        best_scores = _normalize_rows(exact[best]) @ query
+    else:
+        best_scores = scores[best]
+    order = np.argsort(-best_scores)[:top_k]
+    return [(int(best[i]), float(best_scores[i])) for i in order]
+
+def _get_compressed_gallery(method=None):
+    """Return (gallery, exact_vectors), rebuilding the gallery when the embeddings change.
+    
+    The exact float32 vectors used for re-ranking are memory-mapped from disk,
+    so only the compressed codes stay resident.
+    """
+    method = method or GALLERY_METHOD
+    gallery_path = os.path.join(OUTPUT_DIR, f'gallery_{method}.pickle')
+    embeddings_mtime = os.path.getmtime(EMBEDDINGS_PATH)
+    
+    def cached_gallery():
+        with _compressed_gallery_lock:
+            cached = _compressed_gallery_cache.get(method)
+            if cached and cached[0] == embeddings_mtime:
+                return cached[1], cached[2]
+            return None
+    
+    cached = cached_gallery()
+    if cached:
+        return cached
+    with _compressed_gallery_lock:
+        build_lock = _compressed_gallery_build_locks.setdefault(method, threading.Lock())
+    
+    # Build outside _compressed_gallery_lock so a PQ fit does not stall other methods;
+    # the per-method lock keeps concurrent requests from building it twice
+    with build_lock:
+        cached = cached_gallery()
+        if cached:
+            return cached
+        
+        gallery = None
+        if os.path.exists(gallery_path) and os.path.exists(GALLERY_EXACT_PATH):
+            with open(gallery_path, "rb") as f:
+                gallery = pickle.load(f)
+            if gallery.get('embeddings_mtime') != embeddings_mtime:
+                gallery = None
+        
+        if gallery is None:
+            started = time.perf_counter()
+            with open(EMBEDDINGS_PATH, "rb") as f:
+                data = pickle.load(f)
+            gallery = _build_compressed_gallery(data["embeddings"], data["names"], method)
+            gallery['embeddings_mtime'] = embeddings_mtime
+            # Replace rather than overwrite: cached galleries may still memory-map the old file
+            exact_tmp_path = f'{GALLERY_EXACT_PATH}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(exact_tmp_path, "wb") as f:
+                np.save(f, _normalize_rows(data["embeddings"]))
+            os.replace(exact_tmp_path, GALLERY_EXACT_PATH)
+            with open(gallery_path, "wb") as f:
+                pickle.dump(gallery, f)
+            print(f"[INFO] Built {method} gallery: {gallery['count']} embeddings, "
+                  f"{gallery['bytes'] / 1024:.1f} KB in {time.perf_counter() - started:.2f}s")
+        
+        exact = np.load(GALLERY_EXACT_PATH, mmap_mode='r')
+        gallery['masks'] = {}
+        with _compressed_gallery_lock:
+            _compressed_gallery_cache[method] = (embeddings_mtime, gallery, exact)
+        return gallery, exact
+
+def _benchmark_galleries(methods=None, sample=500, rerank=GALLERY_RERANK):
+    """Compare compressed galleries against exact search on embeddings.pickle.
+    
+    Each sampled embedding is used as a query against all the others
+    (leave-one-out), and counts as correct if the top match is the same user.
+    """
+    methods = methods or list(GALLERY_METHODS)
+    with open(EMBEDDINGS_PATH, "rb") as f:
+        data = pickle.load(f)
+    vectors = _normalize_rows(data["embeddings"])
+    names = np.asarray(data["names"])
+    
+    rng = np.random.default_rng(42)
+    queries = rng.choice(len(vectors), size=min(sample, len(vectors)), replace=False)
+    
+    def top1_accuracy(search):
+        correct = 0
+        for i in queries:
+            mask = np.ones(len(vectors), dtype=bool)
+            mask[i] = False
+            matches = search(vectors[i], mask)
+            correct += bool(matches) and names[matches[0][0]] == names[i]
+        return correct / len(queries)
+    
+    exact_scores = lambda q, mask: [(int(np.argmax(np.where(mask, vectors @ q, -np.inf))), None)]
+    baseline_bytes = int(len(vectors) * vectors.shape[1] * 8)
+    baseline_accuracy = top1_accuracy(exact_scores)
+    
+    report = {
+        'embeddings': int(len(vectors)),
+        'queries': int(len(queries)),
+        'float64_bytes': baseline_bytes,
+        'exact_top1_accuracy': round(baseline_accuracy, 4),
+        'methods': {}
+    }
+    for method in methods:
+        started = time.perf_counter()
+        gallery = _build_compressed_gallery(vectors, names, method)
+        build_seconds = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        approx = top1_accuracy(lambda q, mask: _search_gallery(gallery, q, mask=mask))
+        search_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        reranked = top1_accuracy(lambda q, mask: _search_gallery(gallery, q, vectors, rerank=rerank, mask=mask))
+        
+        report['methods'][method] = {
+            'bytes': gallery['bytes'],
+            'memory_saved': round(1 - gallery['bytes'] / baseline_bytes, 4),
+            'compression_ratio': round(baseline_bytes / gallery['bytes'], 1),
+            'top1_accuracy': round(approx, 4),
+            'top1_accuracy_lost': round(baseline_accuracy - approx, 4),
+            'reranked_top1_accuracy': round(reranked, 4),
+            'reranked_top1_accuracy_lost': round(baseline_accuracy - reranked, 4),
+            'search_ms_per_query': round(search_ms, 3),
+            'build_seconds': round(build_seconds, 3)
+        }
+    return report
+
+def _classifier_matcher(recognizer, le, allowed=None):
+    """Match with a classifier, optionally only accepting the users in `allowed`.
+    
+    Returns None if none of the allowed users are known to the classifier.
+    """
+    columns = None
+    if allowed is not None:
+        columns = np.flatnonzero(np.isin(le.classes_, list(allowed)))
+        if len(columns) == 0:
+            return None
+    
+    def match(vec):
+        preds = recognizer.predict_proba(vec)[0]
+        if columns is None:
+            j = np.argmax(preds)
+        else:
+            j = columns[np.argmax(preds[columns])]
+        return le.classes_[j], preds[j]
+    return match
+
+def _gallery_matcher(gallery, exact, class_name=None):
+    """Match by similarity search, restricted to a class roster if given.
+    
+    Returns None if nobody in the class has embeddings in the gallery.
+    """
+    mask = None
+    if class_name:
+        class_key = _normalize_class(class_name)
+        mask = gallery['masks'].get(class_key)
+        if mask is None:
+            roster = _get_roster(class_name)
+            if not roster:
+                return None
+            mask = np.isin(gallery['names'], list(roster))
+            if not mask.any():
+                return None
+            # Only classes with enrolled users are cached, so arbitrary names cannot grow it
+            gallery['masks'][class_key] = mask
+    
+    def match(vec):
+        matches = _search_gallery(gallery, vec, exact, mask=mask)
+        if not matches:
+            return None, 0.0
+        return gallery['names'][matches[0][0]], matches[0][1]
+    return match
+
+def _recognize(image_bytes, confidence_threshold, class_name=None, fallback_global=False, matcher='classifier'):
+    """Detect and recognize faces in an encoded image.
+    
+    With class_name, faces are matched against that class's roster only.
+    With fallback_global, faces not matched in the roster are retried
+    against the global recognizer. matcher='gallery' matches by cosine
+    similarity against the compressed embedding gallery instead of the
+    trained classifier; confidence_threshold then applies to the similarity.
+    """
+    # Load models (cached after the first request)
+    galleries = []
+    warning = None
+    if matcher == 'gallery':
+        gallery, exact = _get_compressed_gallery()
+        global_matcher = lambda: _gallery_matcher(gallery, exact)
+        class_matcher = _gallery_matcher(gallery, exact, class_name) if class_name else None
+    else:
+        global_matcher = lambda: _classifier_matcher(*_get_recognizer())
+        class_matcher = None
+        if class_name:
+            # The global model limited to the roster keeps confidences calibrated
+            # against every enrolled user, so outsiders still score low
+            roster = _get_roster(class_name)
+            if roster:
+                class_matcher = _classifier_matcher(*_get_recognizer(), allowed=roster)
+    
+    if class_matcher:
+        galleries.append((f'class:{class_name}', class_matcher))
+    elif class_name:
+        warning = f"No enrolled users with embeddings found for class '{class_name}', matched against all users"
+        print(f"[WARN] {warning}")
+    if not galleries or fallback_global:
+        galleries.append(('global', global_matcher()))
+    
+    # Read and process image
+    file_bytes = np.frombuffer(image_bytes, np.uint8)
+    image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+    image = imutils.resize(image, width=600)
+    (h, w) = image.shape[:2]
+    
+    results = []
+    faces_detected = 0
+    faces_recognized = 0
+    faces = []
+    
+    with _dnn_nets() as (detector, embedder):
         # Detect faces
         imageBlob = cv2.dnn.blobFromImage(
             cv2.resize(image, (300, 300)), 1.0, (300, 300),
@@ -615,10 +1655,6 @@ def recognize_image():
         detector.setInput(imageBlob)
         detections = detector.forward()
         
-        results = []
-        faces_detected = 0
-        faces_recognized = 0
-        
         for i in range(0, detections.shape[2]):
             confidence = detections[0, 0, i, 2]
             
@@ -638,49 +1674,257 @@ def recognize_image():
                     (96, 96), (0, 0, 0), swapRB=True, crop=False)
                 embedder.setInput(faceBlob)
                 vec = embedder.forward()
-                
-                # Recognize
-                preds = recognizer.predict_proba(vec)[0]
-                j = np.argmax(preds)
-                proba = preds[j]
-                name = le.classes_[j]
-                
-                if proba >= confidence_threshold:
-                    faces_recognized += 1
-                    
-                    # Draw on image
-                    text = f"{name}: {proba:.2f}"
-                    y = startY - 10 if startY - 10 > 10 else startY + 10
-                    cv2.rectangle(image, (startX, startY), (endX, endY), (0, 255, 0), 2)
-                    cv2.putText(image, text, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 0), 2)
-                    
-                    results.append({
-                        'usn': name,
-                        'name': name,
-                        'confidence': float(proba),
-                        'bbox': [int(startX), int(startY), int(endX), int(endY)]
-                    })
-        
-        # Save processed image
-        batch_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        batch_dir = os.path.join(IMAGE_DATA_DIR, batch_id)
-        os.makedirs(batch_dir, exist_ok=True)
+                faces.append(((startX, startY, endX, endY), vec))
+    
+    for (startX, startY, endX, endY), vec in faces:
+        # Recognize, trying the class roster before the global gallery
+        for gallery, match in galleries:
+            name, proba = match(vec)
+            if proba >= confidence_threshold:
+                break
+        
+        if proba >= confidence_threshold:
+            faces_recognized += 1
+            
+            # Draw on image
+            text = f"{name}: {proba:.2f}"
+            y = startY - 10 if startY - 10 > 10 else startY + 10
+            cv2.rectangle(image, (startX, startY), (endX, endY), (0, 255, 0), 2)
+            cv2.putText(image, text, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 0), 2)
+            
+            results.append({
+                'usn': name,
+                'name': name,
+                'confidence': float(proba),
+                'bbox': [int(startX), int(startY), int(endX), int(endY)],
+                'gallery': gallery
+            })
+    
+    # Save processed image and thumbnail
+    batch_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    image_name, thumbnail_name = _save_processed_image(image, batch_id)
+    
+    return {
+        'success': True,
+        'faces_detected': faces_detected,
+        'faces_recognized': faces_recognized,
+        'results': results,
+        'gallery': galleries[0][0],
+        **({'warning': warning} if warning else {}),
+        'processed_image_url': f'/api/images/{batch_id}/{image_name}',
+        'thumbnail_url': f'/api/images/{batch_id}/{thumbnail_name}'
+    }
+
+class _AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class _AdmissionController:
+    """Bounded concurrency with a priority queue of waiting requests.
+    
+    Up to `slots` requests run at once. Others wait in order of lane priority
+    and arrival until their deadline; a full queue rejects immediately, except
+    that a higher-priority request displaces the newest lowest-priority waiter.
+    """
+    
+    def __init__(self, slots, max_queue, timeout):
+        if slots < 1:
+            raise ValueError(f"MAX_CONCURRENT_RECOGNITIONS must be at least 1, got {slots}")
+        if max_queue < 0:
+            raise ValueError(f"ADMISSION_QUEUE_SIZE must not be negative, got {max_queue}")
+        self.slots = slots
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._free = slots
+        self._waiting = []
+        self._seq = 0
+        self._service_times = deque(maxlen=200)
+        self._stats = {
+            lane: {'admitted': 0, 'rejected': 0, 'timed_out': 0, 'displaced': 0, 'waits': deque(maxlen=1000)}
+            for lane in ADMISSION_LANES
+        }
+    
+    def _retry_after(self):
+        service = sum(self._service_times) / len(self._service_times) if self._service_times else 1.0
+        return max(1, int(service * (len(self._waiting) + 1) / self.slots + 0.999))
+    
+    def _reject(self, lane, status, reason, message):
+        self._stats[lane][reason] += 1
+        return _AdmissionRejected(status, message, self._retry_after())
+    
+    def acquire(self, lane):
+        priority = ADMISSION_LANES[lane]
+        started = time.perf_counter()
+        
+        with self._cond:
+            if self._free > 0 and not self._waiting:
+                self._free -= 1
+                self._stats[lane]['admitted'] += 1
+                self._stats[lane]['waits'].append(0.0)
+                return started
+            
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting, key=lambda item: (item[0], item[1]), default=None)
+                if worst is None or worst[0] <= priority:
+                    raise self._reject(lane, 429, 'rejected', 'Server busy, recognition queue is full')
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                worst[2]['state'] = 'displaced'
+                self._cond.notify_all()
+            
+            self._seq += 1
+            entry = {'state': 'waiting'}
+            heapq.heappush(self._waiting, (priority, self._seq, entry))
+            deadline = started + self.timeout
+            
+            while entry['state'] == 'waiting':
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._waiting = [item for item in self._waiting if item[2] is not entry]
+                    heapq.heapify(self._waiting)
+                    raise self._reject(lane, 503, 'timed_out', 'Server busy, timed out waiting in the recognition queue')
+                self._cond.wait(remaining)
+            
+            if entry['state'] == 'displaced':
+                raise self._reject(lane, 429, 'displaced', 'Server busy, displaced by a higher priority request')
+            
+            self._stats[lane]['admitted'] += 1
+            self._stats[lane]['waits'].append(time.perf_counter() - started)
+            return time.perf_counter()
+    
+    def release(self, admitted_at):
+        with self._cond:
+            self._service_times.append(time.perf_counter() - admitted_at)
+            if self._waiting:
+                # Hand the slot straight to the next waiter so it cannot be taken by a newcomer
+                heapq.heappop(self._waiting)[2]['state'] = 'granted'
+            else:
+                self._free += 1
+            self._cond.notify_all()
+    
+    def metrics(self):
+        with self._cond:
+            lanes = {}
+            for lane, stats in self._stats.items():
+                waits = sorted(stats['waits'])
+                lanes[lane] = {
+                    'admitted': stats['admitted'],
+                    'rejected': stats['rejected'],
+                    'timed_out': stats['timed_out'],
+                    'displaced': stats['displaced'],
+                    'queued': sum(1 for item in self._waiting if item[0] == ADMISSION_LANES[lane]),
+                    'wait_ms': {
+                        'mean': round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                        'p50': round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                        'p95': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                        'max': round(waits[-1] * 1000, 1) if waits else 0.0
+                    }
+                }
+            service = list(self._service_times)
+            return {
+                'slots': self.slots,
+                'in_flight': self.slots - self._free,
+                'queued': len(self._waiting),
+                'max_queue': self.max_queue,
+                'queue_timeout_seconds': self.timeout,
+                'mean_service_ms': round(sum(service) / len(service) * 1000, 1) if service else None,
+                'lanes': lanes
+            }
+
+_admission = _AdmissionController(MAX_CONCURRENT_RECOGNITIONS, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+def admission_controlled(lane):
+    """Run the view only once the admission controller grants it a slot"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                admitted_at = _admission.acquire(lane)
+            except _AdmissionRejected as e:
+                response = jsonify({'success': False, 'error': str(e), 'retry_after': e.retry_after})
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response, e.status
+            try:
+                return view(*args, **kwargs)
+            finally:
+                _admission.release(admitted_at)
+        return wrapper
+    return decorator
+
+@app.route('/api/admission/metrics', methods=['GET'])
+def get_admission_metrics():
+    return jsonify(_admission.metrics())
+
+@app.route('/api/gallery/build', methods=['POST'])
+def build_gallery():
+    try:
+        if not os.path.exists(EMBEDDINGS_PATH):
+            return jsonify({'success': False, 'error': 'No embeddings found. Please extract embeddings first.'}), 400
         
-        output_path = os.path.join(batch_dir, 'recognized.png')
-        cv2.imwrite(output_path, image)
+        data = request.get_json(silent=True) or {}
+        method = data.get('method', GALLERY_METHOD)
+        if method not in GALLERY_METHODS:
+            return jsonify({
+                'success': False,
+                'error': f'Unknown gallery method: {method}. Choose one of {", ".join(GALLERY_METHODS)}'
+            }), 400
         
+        gallery, _ = _get_compressed_gallery(method)
         return jsonify({
             'success': True,
-            'faces_detected': faces_detected,
-            'faces_recognized': faces_recognized,
-            'results': results,
-            'processed_image_url': f'/api/images/{batch_id}/recognized.png'
+            'method': method,
+            'embeddings': gallery['count'],
+            'bytes': gallery['bytes']
         })
     except Exception as e:
         print(f"[ERROR] {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/gallery/benchmark', methods=['POST'])
+def benchmark_gallery():
+    try:
+        if not os.path.exists(EMBEDDINGS_PATH):
+            return jsonify({'success': False, 'error': 'No embeddings found. Please extract embeddings first.'}), 400
+        
+        data = request.get_json(silent=True) or {}
+        methods = data.get('methods', list(GALLERY_METHODS))
+        unknown = [m for m in methods if m not in GALLERY_METHODS]
+        if unknown:
+            return jsonify({
+                'success': False,
+                'error': f'Unknown gallery method: {unknown[0]}. Choose from {", ".join(GALLERY_METHODS)}'
+            }), 400
+        
+        report = _benchmark_galleries(
+            methods, sample=int(data.get('sample', 500)), rerank=int(data.get('rerank', GALLERY_RERANK)))
+        return jsonify({'success': True, **report})
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/recognize/image', methods=['POST'])
+@admission_controlled('recognition')
+def recognize_image():
+    try:
+        if 'image' not in request.files:
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+        
+        file = request.files['image']
+        confidence_threshold = float(request.form.get('confidence_threshold', 0.6))
+        class_name = request.form.get('class_name')
+        fallback_global = request.form.get('fallback_global', 'false').lower() == 'true'
+        matcher = request.form.get('matcher', 'classifier')
+        
+        return jsonify(_recognize(file.read(), confidence_threshold, class_name, fallback_global, matcher))
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/recognize/mark-attendance', methods=['POST'])
+@admission_controlled('attendance')
 def mark_attendance():
     try:
         if 'image' not in request.files:
@@ -693,12 +1937,19 @@ def mark_attendance():
         if not session_id:
             return jsonify({'success': False, 'error': 'Session ID required'}), 400
         
-        # Recognize faces (reuse recognition logic)
-        recognition_result = recognize_image()
-        recognition_data = recognition_result.json
+        # Match only against the session's class roster when it is known
+        session_file = os.path.join(ATTENDANCE_DIR, f"{session_id}.json")
+        class_name = request.form.get('class_name')
+        if not class_name and os.path.exists(session_file):
+            with open(session_file, 'r') as f:
+                class_name = json.load(f).get('class_name')
+        if request.form.get('scope', 'class') == 'global':
+            class_name = None
+        fallback_global = request.form.get('fallback_global', 'false').lower() == 'true'
+        matcher = request.form.get('matcher', 'classifier')
         
-        if not recognition_data.get('success'):
-            return recognition_result
+        # Recognize faces (reuse recognition logic)
+        recognition_data = _recognize(file.read(), confidence_threshold, class_name, fallback_global, matcher)
         
         # Mark attendance
         attendees = []
@@ -720,7 +1971,6 @@ def mark_attendance():
                 json.dump(attendee, f, indent=2)
         
         # Update session file
-        session_file = os.path.join(ATTENDANCE_DIR, f"{session_id}.json")
         session_data = {
             'session_id': session_id,
             'timestamp': datetime.now().isoformat(),
@@ -740,7 +1990,9 @@ def mark_attendance():
             'success': True,
             'session_id': session_id,
             'marked_count': len(attendees),
-            'attendees': attendees
+            'attendees': attendees,
+            'gallery': recognition_data['gallery'],
+            **({'warning': recognition_data['warning']} if recognition_data.get('warning') else {})
         })
     except Exception as e:
         print(f"[ERROR] {str(e)}")
@@ -813,13 +2065,161 @@ def get_session(session_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _save_processed_image(image, batch_id):
+    """Write the annotated image and a thumbnail into a new batch folder"""
+    batch_dir = os.path.join(IMAGE_DATA_DIR, batch_id)
+    os.makedirs(batch_dir, exist_ok=True)
+    thumbnail = imutils.resize(image, width=min(THUMBNAIL_WIDTH, image.shape[1]))
+    
+    formats = [('jpg', cv2.IMWRITE_JPEG_QUALITY)]
+    if PROCESSED_IMAGE_FORMAT == 'webp':
+        formats.insert(0, ('webp', cv2.IMWRITE_WEBP_QUALITY))
+    
+    for ext, quality_flag in formats:
+        params = [quality_flag, PROCESSED_IMAGE_QUALITY]
+        image_name = f'recognized.{ext}'
+        thumbnail_name = f'thumbnail.{ext}'
+        try:
+            written = (cv2.imwrite(os.path.join(batch_dir, image_name), image, params) and
+                       cv2.imwrite(os.path.join(batch_dir, thumbnail_name), thumbnail, params))
+        except cv2.error as e:
+            print(f"[WARN] Could not encode {ext}: {str(e)}")
+            written = False
+        if written:
+            return image_name, thumbnail_name
+        print(f"[WARN] OpenCV could not write {ext} images")
+    
+    raise RuntimeError(f'Failed to save processed image to {batch_dir}')
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _sweep_processed_images(max_age_hours=None, max_mb=None):
+    """Delete batch folders older than max_age_hours, then the oldest ones until under max_mb"""
+    max_age_hours = IMAGE_RETENTION_MAX_AGE_HOURS if max_age_hours is None else max_age_hours
+    max_mb = IMAGE_RETENTION_MAX_MB if max_mb is None else max_mb
+    
+    batches = []
+    for batch_id in os.listdir(IMAGE_DATA_DIR):
+        batch_path = os.path.join(IMAGE_DATA_DIR, batch_id)
+        if os.path.isdir(batch_path) and batch_id.startswith('batch_'):
+            batches.append((os.path.getmtime(batch_path), _dir_size(batch_path), batch_path))
+    batches.sort()
+    
+    now = datetime.now().timestamp()
+    total_bytes = sum(size for _, size, _ in batches)
+    max_bytes = max_mb * 1024 * 1024
+    removed = 0
+    freed_bytes = 0
+    
+    for mtime, size, batch_path in batches:
+        expired = max_age_hours > 0 and now - mtime > max_age_hours * 3600
+        over_limit = max_mb > 0 and total_bytes > max_bytes
+        if not (expired or over_limit):
+            continue
+        shutil.rmtree(batch_path, ignore_errors=True)
+        removed += 1
+        freed_bytes += size
+        total_bytes -= size
+    
+    if removed:
+        print(f"[INFO] Image retention: removed {removed} batches, freed {freed_bytes / (1024 * 1024):.1f} MB")
+    
+    return {
+        'removed_batches': removed,
+        'freed_mb': round(freed_bytes / (1024 * 1024), 2),
+        'remaining_batches': len(batches) - removed,
+        'remaining_mb': round(total_bytes / (1024 * 1024), 2)
+    }
+
+def _image_retention_worker():
+    """Background worker that periodically applies the image retention limits"""
+    while True:
+        try:
+            _sweep_processed_images()
+        except Exception as e:
+            print(f"[ERROR] Image retention sweep failed: {str(e)}")
+        time.sleep(IMAGE_RETENTION_INTERVAL)
+
 @app.route('/api/images/<batch_id>/<filename>', methods=['GET'])
 def get_image(batch_id, filename):
     try:
-        batch_dir = os.path.join(IMAGE_DATA_DIR, batch_id)
-        return send_from_directory(batch_dir, filename)
+        # Batch folders are never modified after creation, so they can be cached aggressively.
+        # conditional=True answers If-None-Match/If-Modified-Since and Range requests.
+        response = send_from_directory(
+            IMAGE_DATA_DIR, f'{batch_id}/{filename}',
+            conditional=True, etag=True, max_age=IMAGE_CACHE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 404
 
+@app.route('/api/images/cleanup', methods=['POST'])
+def cleanup_images():
+    try:
+        data = request.get_json(silent=True) or {}
+        result = _sweep_processed_images(
+            max_age_hours=float(data.get('max_age_hours', IMAGE_RETENTION_MAX_AGE_HOURS)),
+            max_mb=float(data.get('max_mb', IMAGE_RETENTION_MAX_MB)))
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+_background_lock = threading.Lock()
+_background_started = False
+
+def _start_background_tasks():
+    """Start the warm-up and image retention threads, once per serving process"""
+    global _background_started
+    
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    if IMAGE_RETENTION_INTERVAL > 0:
+        threading.Thread(target=_image_retention_worker, daemon=True).start()
+    if WARMUP_ON_START:
+        threading.Thread(target=_warm_up, daemon=True).start()
+
+@app.before_request
+def _ensure_background_tasks():
+    # Servers that import the app (gunicorn, waitress) start them on the first request, e.g. a /ready probe
+    if not _background_started:
+        _start_background_tasks()
+
+readiness_state['import_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 3)
+print(f"[INFO] App module imported in {readiness_state['import_seconds']:.3f}s")
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Face recognition API')
+    parser.add_argument('--worker', action='store_true',
+                        help='run as a shard worker for distributed embedding extraction')
+    parser.add_argument('--once', action='store_true',
+                        help='with --worker, exit when the shard queue is empty')
+    parser.add_argument('--worker-id', help='with --worker, name reported to the coordinator')
+    parser.add_argument('--benchmark-gallery', action='store_true',
+                        help='report memory saved and top-1 accuracy lost by each compressed gallery')
+    parser.add_argument('--sample', type=int, default=500,
+                        help='with --benchmark-gallery, number of leave-one-out queries')
+    args = parser.parse_args()
+    
+    if args.worker:
+        _run_shard_worker(worker_id=args.worker_id, once=args.once)
+    elif args.benchmark_gallery:
+        print(json.dumps(_benchmark_galleries(sample=args.sample), indent=2))
+    else:
+        # With the debug reloader this script also runs in the file-watching parent,
+        # which never serves requests; only the child sets WERKZEUG_RUN_MAIN
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            _start_background_tasks()
+        app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file